@@ -1,15 +1,27 @@
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
-from datetime import datetime
+import numpy as np
+from datetime import datetime, timedelta
 import os
 from dotenv import load_dotenv
 import time
 import sqlite3
 import json
-from typing import List, Dict, Optional
+import hashlib
+import re
+from typing import List, Dict, Optional, Set, Tuple
 import logging
 import argparse
+import atexit
+from collections import deque
+import asyncio
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Import condicional para Gemini
 try:
@@ -34,6 +46,125 @@ logger = logging.getLogger(__name__)
 # Cargar variables de entorno
 load_dotenv()
 
+# Número máximo de parámetros por consulta "IN (...)" en SQLite
+DB_BATCH_SIZE = 500
+
+# Caché semántica de categorías: modelo de embeddings y similitud coseno mínima
+EMBEDDING_MODEL_NAME = "models/text-embedding-004"
+EMBEDDING_BATCH_SIZE = 100
+SEMANTIC_CACHE_THRESHOLD = 0.92
+# Cuota propia del modelo de embeddings (no consume la de generación) y número
+# máximo de entradas de la caché semántica (se descartan las más antiguas)
+EMBEDDING_RPM_LIMIT = 1500
+SEMANTIC_CACHE_MAX_ENTRIES = 5000
+
+# Peticiones a Spotify: hilos simultáneos, ritmo máximo y reintentos ante 429
+SPOTIFY_MAX_WORKERS = 8
+SPOTIFY_REQUESTS_PER_SECOND = 10
+SPOTIFY_MAX_RETRIES = 6
+SPOTIFY_MAX_BACKOFF = 60
+# Códigos que reintenta urllib3 dentro de spotipy; el 429 se deja a _spotify_call,
+# que lo recibe con sus cabeceras (Retry-After) y aplica SPOTIFY_MAX_BACKOFF
+SPOTIFY_RETRY_STATUS_CODES = (500, 502, 503, 504)
+SPOTIFY_HTTP_RETRIES = 3
+SPOTIFY_EPISODES_BATCH_SIZE = 50
+# Campos pedidos a playlist_items: lo necesario para construir cada episodio
+SPOTIFY_PLAYLIST_ITEMS_FIELDS = (
+    "items(added_at,track(type,id,name,description,html_description,"
+    "duration_ms,external_urls(spotify),show(name))),next"
+)
+
+# Episodios por petición de categorización y peticiones simultáneas a Gemini
+CATEGORIZATION_CHUNK_SIZE = 50
+CATEGORIZATION_CONCURRENCY = 5
+# Caracteres de la descripción que se envían a Gemini (se recortan ya en la consulta)
+PROMPT_DESCRIPTION_CHARS = 400
+
+# Plantillas del prompt de categorización. El prefijo fijo (instrucciones +
+# categorías) se reutiliza entre lotes; el cuerpo lleva los episodios.
+_CATEGORIZATION_PROMPT_PREFIX = """
+ROL: Eres un asistente de IA experto en clasificación de contenido.
+OBJETIVO: Agrupar una lista de podcasts en un sistema de categorías coherente y limitado.
+RESTRICCIÓN CRÍTICA E INQUEBRANTABLE:
+El número total de categorías ÚNICAS en toda tu respuesta NO PUEDE ser superior a {max_categories}. Esta es la regla más importante.
+CONTEXTO DE CATEGORÍAS:
+{prompt_context}
+PROCESO:
+1. Analiza el contenido de TODOS los episodios en el JSON de entrada.
+2. Decide qué categorías vas a usar, obedeciendo la RESTRICCIÓN CRÍTICA y el CONTEXTO.
+3. Asigna UNA SOLA categoría a cada episodio. Las categorías deben ser concisas (2-3 palabras).
+FORMATO DE SALIDA:
+Tu respuesta DEBE SER un único objeto JSON válido, sin texto, comentarios o explicaciones adicionales.
+"""
+_CATEGORIZATION_PROMPT_BODY = """
+JSON DE ENTRADA:
+{episodes_json}
+Genera el objeto JSON de respuesta.
+"""
+
+# Respuestas del LLM que no se aceptan como categoría (comparadas en minúsculas)
+_INVALID_CATEGORIES = frozenset(("", "error", "unknown", "sin categorizar"))
+
+# Vallas de bloque de código Markdown (```json ... ```) alrededor de la respuesta
+_FENCE = re.compile(r"^```(?:json)?\s*|\s*```\s*$")
+
+# idx_podcasts_cat se elimina y recrea alrededor de la carga solo si llegan al menos
+# BULK_LOAD_INDEX_THRESHOLD filas y no menos de las que ya tiene la tabla: recrearlo
+# recorre la tabla entera, y en tablas grandes mantenerlo fila a fila cuesta menos
+BULK_LOAD_INDEX_THRESHOLD = 1000
+
+# Filas leídas de SQLite por bloque al exportar a Excel
+EXPORT_CHUNK_SIZE = 5000
+
+# Cabeceras de las columnas en el Excel exportado
+_EXPORT_COLUMN_NAMES = {
+    "titulo": "Título",
+    "descripcion": "Descripción",
+    "duracion_minutos": "Duración (min)",
+    "fecha_agregado_playlist": "Fecha Agregado",
+    "url_spotify": "URL Spotify",
+    "categoria": "Categoría",
+    "podcast_show_name": "Podcast",
+    "playlist_id": "ID Playlist",
+    "fecha_procesado": "Fecha Procesado",
+}
+
+# Sentencias SQL del camino caliente, definidas una vez para reutilizar la caché
+# de sentencias preparadas de la conexión persistente
+# UPSERT: actualiza la fila existente en su sitio (sin DELETE + INSERT), conserva
+# fecha_procesado y no pisa una categoría ya asignada
+_SQL_INSERT_EPISODE = """
+    INSERT INTO podcasts (id, titulo, descripcion, duracion_minutos,
+    fecha_agregado_playlist, url_spotify, categoria, podcast_show_name, playlist_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(id, playlist_id) DO UPDATE SET
+        titulo = excluded.titulo,
+        descripcion = excluded.descripcion,
+        duracion_minutos = excluded.duracion_minutos,
+        fecha_agregado_playlist = excluded.fecha_agregado_playlist,
+        url_spotify = excluded.url_spotify,
+        categoria = CASE WHEN podcasts.categoria = 'Sin categorizar'
+            THEN excluded.categoria ELSE podcasts.categoria END,
+        podcast_show_name = excluded.podcast_show_name
+"""
+_SQL_CREATE_CATEGORY_INDEX = (
+    "CREATE INDEX IF NOT EXISTS idx_podcasts_cat ON podcasts(categoria)"
+)
+_SQL_EPISODE_EXISTS = "SELECT 1 FROM podcasts WHERE id = ? AND playlist_id = ?"
+_SQL_UPDATE_CATEGORY = (
+    "UPDATE podcasts SET categoria = ? WHERE id = ? AND playlist_id = ?"
+)
+
+# PRAGMAs aplicados a cada conexión SQLite
+# (WAL + fsync reducido para escrituras masivas)
+SQLITE_PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "cache_size=-65536",
+    "mmap_size=268435456",
+)
+
 
 class SpotifyPodcastExtractor:
     def __init__(
@@ -46,15 +177,29 @@ class SpotifyPodcastExtractor:
         model_name: str = "gemini-1.5-flash",
         rpm_limit: int = 15,
         max_categories: int = 10,
+        semantic_cache_threshold: float = SEMANTIC_CACHE_THRESHOLD,
     ):
         self.scope = "playlist-read-private playlist-read-collaborative"
         self.db_path = db_path
         self.model = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
         self.quota_exhausted = False
         self.rpm_limit = rpm_limit
-        self.request_timestamps = []
+        self.request_timestamps = deque(maxlen=max(rpm_limit, 1))
+        self.embedding_timestamps = deque(maxlen=EMBEDDING_RPM_LIMIT)
         self.max_categories = max_categories
+        self.semantic_cache_threshold = semantic_cache_threshold
+        # (matriz de embeddings, categorías) de categories_cache, cargada en frío
+        self._semantic_cache: Optional[Tuple[np.ndarray, List[str]]] = None
+        self.cache_stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0}
+        self._categories_cache: Optional[List[str]] = None
+        self._categories_joined: Optional[str] = None
+        self._prompt_prefix: Optional[str] = None
         self.sp = None  # Inicializamos la conexión a None
+        self._spotify_lock = threading.Lock()
+        self._spotify_timestamps = deque()
+        self._spotify_blocked_until = 0.0  # Fin de la espera tras un 429, para todos
+        self.conn: Optional[sqlite3.Connection] = None  # Conexión SQLite persistente
 
         # --- CONEXIÓN A SPOTIFY SOLO SI SE PROVEEN CREDENCIALES ---
         if all([client_id, client_secret, redirect_uri]):
@@ -65,7 +210,8 @@ class SpotifyPodcastExtractor:
                     redirect_uri=redirect_uri,
                     scope=self.scope,
                     cache_path=".spotipyoauthcache",
-                )
+                ),
+                requests_session=self._spotify_session(),
             )
 
         # Configuración de Gemini
@@ -81,9 +227,37 @@ class SpotifyPodcastExtractor:
 
         self._init_database()
 
+    def _get_conn(self) -> sqlite3.Connection:
+        # Una única conexión en modo autocommit; las escrituras de varias
+        # sentencias abren su propia transacción con BEGIN/COMMIT.
+        if self.conn is None:
+            self.conn = sqlite3.connect(
+                self.db_path, check_same_thread=False, isolation_level=None
+            )
+            self.conn.row_factory = sqlite3.Row
+            for pragma in SQLITE_PRAGMAS:
+                self.conn.execute(f"PRAGMA {pragma}")
+            atexit.register(self.close)
+        return self.conn
+
+    def close(self):
+        if any(self.cache_stats.values()):
+            logger.info(
+                f"Caché de categorías: {self.cache_stats['exact_hits']} aciertos exactos, "
+                f"{self.cache_stats['semantic_hits']} semánticos, "
+                f"{self.cache_stats['misses']} enviados a Gemini."
+            )
+            self.cache_stats = dict.fromkeys(self.cache_stats, 0)
+        if self._loop is not None:
+            self._loop.close()
+            self._loop = None
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
     def _init_database(self):
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._get_conn() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
                     """
@@ -145,38 +319,138 @@ class SpotifyPodcastExtractor:
                     )
                     """
                 )
-                conn.commit()
+                cursor.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS categories_cache
+                    (
+                        embedding
+                        BLOB
+                        NOT
+                        NULL,
+                        categoria
+                        TEXT
+                        NOT
+                        NULL
+                    )
+                    """
+                )
+                cursor.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS llm_cache
+                    (
+                        prompt_sha256
+                        TEXT
+                        PRIMARY
+                        KEY,
+                        response
+                        TEXT
+                        NOT
+                        NULL,
+                        ts
+                        TEXT
+                        DEFAULT
+                        CURRENT_TIMESTAMP
+                    )
+                    """
+                )
+                # idx_podcasts_cat sirve tanto la búsqueda de pendientes
+                # (categoria = 'Sin categorizar') como el GROUP BY de estadísticas;
+                # un índice parcial de pendientes sería redundante y se escribiría
+                # en cada alta, ya que todo episodio nuevo entra sin categorizar
+                cursor.execute(_SQL_CREATE_CATEGORY_INDEX)
+                # La PK es (id, playlist_id) y no sirve para filtrar por playlist
+                cursor.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_podcasts_playlist ON podcasts(playlist_id, id)"
+                )
                 logger.info(f"Base de datos inicializada: {self.db_path}")
         except sqlite3.Error as e:
             logger.error(f"Error de base de datos: {e}", exc_info=True)
             raise
 
-    def _throttle_requests(self):
-        if not self.use_gemini:
-            return
+    @staticmethod
+    def _throttle_wait_time(timestamps: deque, rpm_limit: int) -> float:
         now = time.time()
-        self.request_timestamps = [t for t in self.request_timestamps if now - t < 60]
-        if len(self.request_timestamps) >= self.rpm_limit:
-            wait_time = 60 - (now - self.request_timestamps[0]) + 0.1
+        while timestamps and now - timestamps[0] >= 60:
+            timestamps.popleft()
+        if len(timestamps) >= rpm_limit:
+            wait_time = 60 - (now - timestamps[0]) + 0.1
             if wait_time > 0:
                 logger.info(
-                    f"Límite de {self.rpm_limit} RPM alcanzado. Esperando {wait_time:.2f}s..."
+                    f"Límite de {rpm_limit} RPM alcanzado. Esperando {wait_time:.2f}s..."
                 )
-                time.sleep(wait_time)
+                return wait_time
+        return 0
+
+    def _throttle_requests(self):
+        if not self.use_gemini:
+            return
+        wait_time = self._throttle_wait_time(self.request_timestamps, self.rpm_limit)
+        if wait_time:
+            time.sleep(wait_time)
         self.request_timestamps.append(time.time())
 
+    def _throttle_embeddings(self):
+        # Ventana separada: los embeddings no ocupan huecos del límite de generación
+        wait_time = self._throttle_wait_time(
+            self.embedding_timestamps, EMBEDDING_RPM_LIMIT
+        )
+        if wait_time:
+            time.sleep(wait_time)
+        self.embedding_timestamps.append(time.time())
+
+    async def _throttle_requests_async(self, lock: asyncio.Lock):
+        # Mismo límite deslizante que _throttle_requests, compartido entre tareas
+        if not self.use_gemini:
+            return
+        async with lock:
+            wait_time = self._throttle_wait_time(
+                self.request_timestamps, self.rpm_limit
+            )
+            if wait_time:
+                await asyncio.sleep(wait_time)
+            self.request_timestamps.append(time.time())
+
     def _get_existing_categories(self) -> List[str]:
+        # Se consulta la BD solo en frío; después se mantiene con _register_categories
+        if self._categories_cache is not None:
+            return self._categories_cache
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._get_conn() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
                     "SELECT DISTINCT categoria FROM podcasts WHERE categoria != 'Sin categorizar'"
                 )
-                return [row[0] for row in cursor.fetchall()]
+                self._categories_cache = [row[0] for row in cursor.fetchall()]
+                self._categories_joined = None
+                self._prompt_prefix = None
+                return self._categories_cache
         except sqlite3.Error as e:
             logger.error(f"No se pudieron obtener las categorías existentes: {e}")
             return []
 
+    def _register_categories(self, categories):
+        if self._categories_cache is None:
+            return
+        known = set(self._categories_cache)
+        new_categories = [
+            cat
+            for cat in dict.fromkeys(categories)
+            if cat and cat != "Sin categorizar" and cat not in known
+        ]
+        if new_categories:
+            # Lista nueva (no se muta la que tienen los llamantes); invalida el texto
+            # unido y el prefijo del prompt
+            self._categories_cache = self._categories_cache + new_categories
+            self._categories_joined = None
+            self._prompt_prefix = None
+
+    def _join_categories(self, categories: List[str]) -> str:
+        if categories is not self._categories_cache:
+            return ", ".join(categories)
+        if self._categories_joined is None:
+            self._categories_joined = ", ".join(categories)
+        return self._categories_joined
+
     def _categorize_episodes_batch(
         self, episodes: List[Dict], existing_categories: List[str]
     ) -> Dict[str, str]:
@@ -188,20 +462,155 @@ class SpotifyPodcastExtractor:
         ):
             return {}
 
-        episodes_for_prompt = [
-            {
-                "id": ep["id"],
-                "titulo": ep["titulo"],
-                "descripcion": ep["descripcion"][:400],
-            }
-            for ep in episodes
+        # 1) Caché exacta por hash de la entrada. Un acierto vale si su categoría ya
+        # existe o si aún cabe en max_categories; si no, el episodio va a Gemini
+        cache_keys = {ep["id"]: self._llm_cache_key(ep) for ep in episodes}
+        exact_hits = self._llm_cache_lookup(list(cache_keys.values()))
+        known = set(existing_categories)
+        categorization_map, cached_new = {}, []
+        for ep in episodes:
+            category = exact_hits.get(cache_keys[ep["id"]])
+            if category is None:
+                continue
+            if category not in known:
+                if len(known) >= self.max_categories:
+                    continue
+                known.add(category)
+                cached_new.append(category)
+            categorization_map[ep["id"]] = category
+        if cached_new:
+            # Las nuevas de la caché cuentan para el límite en el resto del lote
+            existing_categories = existing_categories + cached_new
+        exact_count = len(categorization_map)
+        self.cache_stats["exact_hits"] += exact_count
+        episodes = [ep for ep in episodes if ep["id"] not in categorization_map]
+        if not episodes:
+            logger.info("Caché exacta: todos los episodios ya estaban categorizados.")
+            self._register_categories(categorization_map.values())
+            return categorization_map
+
+        # 2) Caché semántica por similitud de embeddings
+        embeddings = self._embed_episodes(episodes)
+        if embeddings is not None:
+            cached_categories = self._semantic_cache_lookup(embeddings)
+            pending = []
+            for ep, embedding, cached in zip(episodes, embeddings, cached_categories):
+                if cached:
+                    categorization_map[ep["id"]] = cached
+                else:
+                    pending.append((ep, embedding))
+            semantic_hits = len(episodes) - len(pending)
+            self.cache_stats["semantic_hits"] += semantic_hits
+            logger.info(
+                f"Caché: {exact_count} aciertos exactos y {semantic_hits} semánticos sin llamar a Gemini."
+            )
+            episodes = [ep for ep, _ in pending]
+            if not episodes:
+                self._register_categories(categorization_map.values())
+                return categorization_map
+
+        # 3) Gemini para el resto
+        self.cache_stats["misses"] += len(episodes)
+        llm_map = self._request_categories(episodes, existing_categories)
+        self._llm_cache_store(
+            [
+                (cache_keys[ep_id], cat)
+                for ep_id, cat in llm_map.items()
+                if ep_id in cache_keys
+            ]
+        )
+        if embeddings is not None and llm_map:
+            self._semantic_cache_store(
+                [
+                    (embedding, llm_map[ep["id"]])
+                    for ep, embedding in pending
+                    if ep["id"] in llm_map
+                ]
+            )
+        categorization_map.update(llm_map)
+        self._register_categories(categorization_map.values())
+        return categorization_map
+
+    def _request_categories(
+        self, episodes: List[Dict], existing_categories: List[str]
+    ) -> Dict[str, str]:
+        """Categoriza con Gemini en lotes de CATEGORIZATION_CHUNK_SIZE.
+
+        Mientras quede margen para categorías nuevas los lotes se envían de uno en
+        uno, para que las que cree cada lote cuenten en el prompt del siguiente; con
+        el límite de max_categories alcanzado se envían en paralelo por oleadas de
+        CATEGORIZATION_CONCURRENCY. Se corta si se agota la cuota.
+        """
+        chunks = [
+            episodes[i : i + CATEGORIZATION_CHUNK_SIZE]
+            for i in range(0, len(episodes), CATEGORIZATION_CHUNK_SIZE)
         ]
+        # Un único event loop por instancia: el cliente gRPC asíncrono de Gemini
+        # queda ligado al loop en el que se crea.
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        categorization_map = {}
+        known = set(existing_categories)
+        start = 0
+        while start < len(chunks):
+            if self.quota_exhausted:
+                logger.warning(
+                    f"Cuota agotada: {len(chunks) - start} lotes quedan sin categorizar."
+                )
+                break
+            wave_size = (
+                1 if len(known) < self.max_categories else CATEGORIZATION_CONCURRENCY
+            )
+            prompt_prefix = self._categorization_prompt_prefix(existing_categories)
+            wave_map = self._loop.run_until_complete(
+                self._request_chunks_async(
+                    chunks[start : start + wave_size], prompt_prefix
+                )
+            )
+            start += wave_size
+            # Las categorías nuevas que excedan el límite se descartan: esos episodios
+            # siguen 'Sin categorizar' para un próximo intento
+            new_categories = []
+            for ep_id, cat in wave_map.items():
+                if cat not in known:
+                    if len(known) >= self.max_categories:
+                        continue
+                    known.add(cat)
+                    new_categories.append(cat)
+                categorization_map[ep_id] = cat
+            if new_categories:
+                existing_categories = existing_categories + new_categories
+        return categorization_map
+
+    async def _request_chunks_async(
+        self, chunks: List[List[Dict]], prompt_prefix: str
+    ) -> Dict[str, str]:
+        semaphore = asyncio.Semaphore(CATEGORIZATION_CONCURRENCY)
+        throttle_lock = asyncio.Lock()
+        results = await asyncio.gather(
+            *(
+                self._request_chunk_async(
+                    chunk, prompt_prefix, semaphore, throttle_lock
+                )
+                for chunk in chunks
+            )
+        )
+        categorization_map = {}
+        for chunk_map in results:
+            categorization_map.update(chunk_map)
+        return categorization_map
+
+    def _categorization_prompt_prefix(self, existing_categories: List[str]) -> str:
+        # Con la lista cacheada de categorías el prefijo se reutiliza hasta que cambie
+        is_cached_list = existing_categories is self._categories_cache
+        if is_cached_list and self._prompt_prefix is not None:
+            return self._prompt_prefix
 
         if existing_categories:
             num_existing = len(existing_categories)
             can_create = self.max_categories - num_existing
             prompt_context = (
-                f"Actualmente ya existen {num_existing} categorías: {', '.join(existing_categories)}. "
+                f"Actualmente ya existen {num_existing} categorías: {self._join_categories(existing_categories)}. "
                 f"**DEBES PRIORIZAR su uso**. Puedes crear hasta {max(0, can_create)} categorías nuevas si es necesario."
             )
         else:
@@ -209,112 +618,286 @@ class SpotifyPodcastExtractor:
                 "No hay categorías preexistentes. Debes crearlas desde cero."
             )
 
-        prompt = f"""
-        ROL: Eres un asistente de IA experto en clasificación de contenido.
-        OBJETIVO: Agrupar una lista de podcasts en un sistema de categorías coherente y limitado.
-        RESTRICCIÓN CRÍTICA E INQUEBRANTABLE:
-        El número total de categorías ÚNICAS en toda tu respuesta NO PUEDE ser superior a {self.max_categories}. Esta es la regla más importante.
-        CONTEXTO DE CATEGORÍAS:
-        {prompt_context}
-        PROCESO:
-        1. Analiza el contenido de TODOS los episodios en el JSON de entrada.
-        2. Decide qué categorías vas a usar, obedeciendo la RESTRICCIÓN CRÍTICA y el CONTEXTO.
-        3. Asigna UNA SOLA categoría a cada episodio. Las categorías deben ser concisas (2-3 palabras).
-        FORMATO DE SALIDA:
-        Tu respuesta DEBE SER un único objeto JSON válido, sin texto, comentarios o explicaciones adicionales.
-        JSON DE ENTRADA:
-        {json.dumps(episodes_for_prompt, ensure_ascii=False, indent=2)}
-        Genera el objeto JSON de respuesta.
-        """
+        prompt_prefix = _CATEGORIZATION_PROMPT_PREFIX.format(
+            max_categories=self.max_categories, prompt_context=prompt_context
+        )
+        if is_cached_list:
+            self._prompt_prefix = prompt_prefix
+        return prompt_prefix
+
+    @staticmethod
+    def _categorization_prompt_body(episodes: List[Dict]) -> str:
+        episodes_for_prompt = [
+            {
+                "id": ep["id"],
+                "titulo": ep["titulo"],
+                "descripcion": (ep["descripcion"] or "")[:PROMPT_DESCRIPTION_CHARS],
+            }
+            for ep in episodes
+        ]
+        return _CATEGORIZATION_PROMPT_BODY.format(
+            episodes_json=json.dumps(
+                episodes_for_prompt, ensure_ascii=False, separators=(",", ":")
+            )
+        )
 
-        logger.info("=" * 80)
-        logger.info("PROMPT QUE SE ENVIARÁ A GEMINI:")
-        logger.info(prompt)
-        logger.info("=" * 80)
+    async def _request_chunk_async(
+        self,
+        episodes: List[Dict],
+        prompt_prefix: str,
+        semaphore: asyncio.Semaphore,
+        throttle_lock: asyncio.Lock,
+    ) -> Dict[str, str]:
+        prompt = prompt_prefix + self._categorization_prompt_body(episodes)
+        # El prompt completo solo se vuelca con --verbose (nivel DEBUG)
+        logger.debug(
+            "Prompt de categorización (%d episodios, %d caracteres)",
+            len(episodes),
+            len(prompt),
+        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(prompt)
 
         response = None
+        async with semaphore:
+            if self.quota_exhausted:
+                return {}
+            try:
+                await self._throttle_requests_async(throttle_lock)
+                logger.info(f"Enviando lote de {len(episodes)} episodios a Gemini...")
+                response = await self.model.generate_content_async(prompt)
+                categorization_map = self._clean_categories(
+                    self._parse_json_response(response.text)
+                )
+
+                unique_categories_in_response = set(categorization_map.values())
+                logger.info(
+                    f"LLM ha generado {len(unique_categories_in_response)} categorías únicas para este lote."
+                )
+
+                return categorization_map
+            except (ResourceExhausted, json.JSONDecodeError, Exception) as e:
+                if isinstance(e, ResourceExhausted):
+                    logger.warning("⚠️ Cuota de API de Gemini agotada.")
+                    self.quota_exhausted = True
+                elif isinstance(e, json.JSONDecodeError):
+                    error_text = (
+                        response.text if response else "Sin respuesta recibida."
+                    )
+                    logger.error(f"Error de formato JSON.\nRespuesta: {error_text}")
+                else:
+                    logger.error(f"Error en categorización: {e}", exc_info=True)
+                return {}
+
+    @staticmethod
+    def _parse_json_response(text: str) -> Dict:
+        cleaned = _FENCE.sub("", text.strip())
         try:
-            logger.info(f"Enviando lote de {len(episodes)} episodios a Gemini...")
-            self._throttle_requests()
-            response = self.model.generate_content(prompt)
-            cleaned_response_text = (
-                response.text.strip().replace("```json", "").replace("```", "").strip()
+            return json.loads(cleaned)
+        except json.JSONDecodeError:
+            # Texto extra alrededor del objeto: se reintenta con el tramo entre llaves
+            start, end = cleaned.find("{"), cleaned.rfind("}")
+            if start == -1 or end <= start:
+                raise
+            return json.loads(cleaned[start : end + 1])
+
+    @staticmethod
+    def _clean_categories(raw_map: Dict) -> Dict[str, str]:
+        # Se recorta antes de strip (menos bytes) y se descartan valores no válidos,
+        # que así siguen como 'Sin categorizar' para un próximo intento
+        categorization_map = {}
+        for ep_id, value in raw_map.items():
+            category = str(value)[:50].strip() if value is not None else ""
+            if category.lower() not in _INVALID_CATEGORIES:
+                categorization_map[ep_id] = category
+        return categorization_map
+
+    @staticmethod
+    def _llm_cache_key(ep: Dict) -> str:
+        # Sin la lista de categorías, que cambia en cuanto un lote crea alguna: la
+        # validez del acierto se comprueba en _categorize_episodes_batch
+        raw = (
+            f"{ep['podcast_show_name'] or ''}|{ep['titulo']}"
+            f"|{(ep['descripcion'] or '')[:PROMPT_DESCRIPTION_CHARS]}"
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _llm_cache_lookup(self, keys: List[str]) -> Dict[str, str]:
+        hits = {}
+        with self._get_conn() as conn:
+            for start in range(0, len(keys), DB_BATCH_SIZE):
+                chunk = keys[start : start + DB_BATCH_SIZE]
+                placeholders = ", ".join("?" * len(chunk))
+                hits.update(
+                    conn.execute(
+                        f"SELECT prompt_sha256, response FROM llm_cache WHERE prompt_sha256 IN ({placeholders})",
+                        chunk,
+                    ).fetchall()
+                )
+        return hits
+
+    def _llm_cache_store(self, entries: List[Tuple[str, str]]):
+        if not entries:
+            return
+        with self._get_conn() as conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT OR IGNORE INTO llm_cache (prompt_sha256, response, ts) VALUES (?, ?, CURRENT_TIMESTAMP)",
+                entries,
             )
-            categorization_map = json.loads(cleaned_response_text)
+            conn.commit()
 
-            unique_categories_in_response = set(categorization_map.values())
-            logger.info(
-                f"LLM ha generado {len(unique_categories_in_response)} categorías únicas para este lote."
+    def _embed_episodes(self, episodes: List[Dict]) -> Optional[np.ndarray]:
+        """Devuelve una matriz de embeddings normalizados (una fila por episodio)."""
+        if self.semantic_cache_threshold >= 1:
+            return None
+        texts = [
+            f"{ep['podcast_show_name'] or ''} | {ep['titulo']} | "
+            f"{(ep['descripcion'] or '')[:PROMPT_DESCRIPTION_CHARS]}"
+            for ep in episodes
+        ]
+        vectors = []
+        try:
+            for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+                self._throttle_embeddings()
+                result = genai.embed_content(
+                    model=EMBEDDING_MODEL_NAME,
+                    content=texts[start : start + EMBEDDING_BATCH_SIZE],
+                    task_type="semantic_similarity",
+                )
+                vectors.extend(result["embedding"])
+        except Exception as e:
+            logger.warning(
+                f"⚠️ No se pudieron calcular embeddings, se omite la caché: {e}"
             )
+            return None
+        matrix = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+    def _load_semantic_cache(self, dim: int) -> Tuple[np.ndarray, List[str]]:
+        # Se lee categories_cache una vez; después se mantiene en memoria al guardar
+        if self._semantic_cache is None or self._semantic_cache[0].shape[1] != dim:
+            with self._get_conn() as conn:
+                rows = conn.execute(
+                    "SELECT embedding, categoria FROM categories_cache "
+                    "ORDER BY rowid DESC LIMIT ?",
+                    (SEMANTIC_CACHE_MAX_ENTRIES,),
+                ).fetchall()
+            rows = [(blob, cat) for blob, cat in reversed(rows) if len(blob) == dim * 4]
+            matrix = np.empty((len(rows), dim), dtype=np.float32)
+            for i, (blob, _) in enumerate(rows):
+                matrix[i] = np.frombuffer(blob, dtype=np.float32)
+            self._semantic_cache = (matrix, [cat for _, cat in rows])
+        return self._semantic_cache
+
+    def _semantic_cache_lookup(self, embeddings: np.ndarray) -> List[Optional[str]]:
+        cache_matrix, categories = self._load_semantic_cache(embeddings.shape[1])
+        if not categories:
+            return [None] * len(embeddings)
+        similarities = embeddings @ cache_matrix.T
+        best = similarities.argmax(axis=1)
+        return [
+            (
+                categories[idx]
+                if similarities[row, idx] > self.semantic_cache_threshold
+                else None
+            )
+            for row, idx in enumerate(best)
+        ]
 
-            return categorization_map
-        except (ResourceExhausted, json.JSONDecodeError, Exception) as e:
-            if isinstance(e, ResourceExhausted):
-                logger.warning("⚠️ Cuota de API de Gemini agotada.")
-                self.quota_exhausted = True
-            elif isinstance(e, json.JSONDecodeError):
-                error_text = response.text if response else "Sin respuesta recibida."
-                logger.error(f"Error de formato JSON.\nRespuesta: {error_text}")
-            else:
-                logger.error(f"Error en categorización: {e}", exc_info=True)
-            return {}
+    def _semantic_cache_store(self, entries: List[Tuple[np.ndarray, str]]):
+        if not entries:
+            return
+        # Solo llegan fallos de la caché; dentro del lote se descartan los casi
+        # idénticos a una entrada ya aceptada
+        vectors = np.vstack([embedding for embedding, _ in entries])
+        similarities = vectors @ vectors.T
+        keep = []
+        for i in range(len(entries)):
+            if not keep or similarities[i, keep].max() <= self.semantic_cache_threshold:
+                keep.append(i)
+        entries = [entries[i] for i in keep]
+        with self._get_conn() as conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT INTO categories_cache (embedding, categoria) VALUES (?, ?)",
+                [(embedding.tobytes(), cat) for embedding, cat in entries],
+            )
+            conn.execute(
+                "DELETE FROM categories_cache WHERE rowid NOT IN "
+                "(SELECT rowid FROM categories_cache ORDER BY rowid DESC LIMIT ?)",
+                (SEMANTIC_CACHE_MAX_ENTRIES,),
+            )
+            conn.commit()
+        if self._semantic_cache is not None:
+            cache_matrix, categories = self._semantic_cache
+            if cache_matrix.shape[1] == vectors.shape[1]:
+                cache_matrix = np.vstack([cache_matrix, vectors[keep]])
+                categories = categories + [cat for _, cat in entries]
+                self._semantic_cache = (
+                    cache_matrix[-SEMANTIC_CACHE_MAX_ENTRIES:],
+                    categories[-SEMANTIC_CACHE_MAX_ENTRIES:],
+                )
 
     def get_playlist_episodes(self, playlist_id: str) -> List[Dict]:
         try:
             if not self.sp:
                 logger.error("La conexión con Spotify no está inicializada.")
                 return []
-            playlist_info = self.sp.playlist(playlist_id)
-            playlist_name = playlist_info["name"]
-            logger.info(f"Procesando playlist: {playlist_name}")
-            results = self.sp.playlist_items(playlist_id, additional_types=("track",))
-            episodes_to_process, episodes_skipped = [], 0
-            while results:
-                for item in results["items"]:
-                    if not (
-                        item
-                        and item.get("track")
-                        and item["track"]["type"] == "episode"
-                    ):
-                        continue
-
-                    episode_summary = item["track"]
-                    episode_id = episode_summary["id"]
-
-                    if self.episode_exists_in_db(episode_id, playlist_id):
-                        episodes_skipped += 1
-                        continue
-
-                    full_episode_details = self.sp.episode(episode_id)
-                    descripcion = (
-                        full_episode_details.get("description", "")
-                        or full_episode_details.get("html_description", "")
-                        or "Sin descripción"
-                    )
-
-                    episodes_to_process.append(
-                        {
-                            "id": episode_id,
-                            "titulo": episode_summary.get("name", "Sin título"),
-                            "descripcion": descripcion,
-                            "duracion_minutos": round(
-                                episode_summary.get("duration_ms", 0) / 60000, 2
-                            ),
-                            "fecha_agregado_playlist": item.get(
-                                "added_at", "Sin fecha"
-                            ),
-                            "url_spotify": episode_summary.get("external_urls", {}).get(
-                                "spotify", "Sin URL"
-                            ),
-                            "podcast_show_name": full_episode_details.get(
-                                "show", {}
-                            ).get("name", "Desconocido"),
-                            "categoria": "Sin categorizar",
-                        }
+            new_items, episodes_skipped = [], 0
+            # Se pide la página siguiente en segundo plano mientras se procesa la actual
+            # (como máximo una petición adelantada)
+            with ThreadPoolExecutor(max_workers=1) as prefetcher:
+                # Solo el nombre: sin fields la respuesta incluye ya la primera página
+                # de elementos, que se pide igualmente con playlist_items
+                playlist_info = prefetcher.submit(
+                    self._spotify_call, self.sp.playlist, playlist_id, fields="name"
+                )
+                # Con "episode" los episodios llegan completos (descripción y podcast)
+                # en lugar de como pistas, sin petición de detalle por episodio
+                results = self._spotify_call(
+                    self.sp.playlist_items,
+                    playlist_id,
+                    fields=SPOTIFY_PLAYLIST_ITEMS_FIELDS,
+                    additional_types=("episode",),
+                )
+                existing_ids = self._get_playlist_episode_ids(playlist_id)
+                playlist_name = playlist_info.result()["name"]
+                logger.info(f"Procesando playlist: {playlist_name}")
+                while results:
+                    next_page = (
+                        prefetcher.submit(self._spotify_call, self.sp.next, results)
+                        if results.get("next")
+                        else None
                     )
-                results = (
-                    self.sp.next(results) if results and results.get("next") else None
+                    for item in results["items"]:
+                        if not (
+                            item
+                            and item.get("track")
+                            and item["track"]["type"] == "episode"
+                        ):
+                            continue
+                        if item["track"]["id"] in existing_ids:
+                            episodes_skipped += 1
+                            continue
+                        new_items.append(item)
+                    results = next_page.result() if next_page else None
+
+            # Solo se piden detalles de los episodios que lleguen incompletos
+            details = self._fetch_episode_details(
+                [
+                    item["track"]["id"]
+                    for item in new_items
+                    if not self._has_episode_details(item["track"])
+                ]
+            )
+            episodes_to_process = [
+                self._build_episode_data(
+                    item, details.get(item["track"]["id"], item["track"])
                 )
+                for item in new_items
+            ]
 
             if self.use_gemini and episodes_to_process:
                 existing_categories = self._get_existing_categories()
@@ -329,8 +912,7 @@ class SpotifyPodcastExtractor:
                         ep["id"], "Sin categorizar"
                     )
 
-            for ep in episodes_to_process:
-                self.save_episode_to_db(ep, playlist_id)
+            self.save_episodes_to_db(episodes_to_process, playlist_id)
 
             logger.info(
                 f"Completado: {len(episodes_to_process)} nuevos procesados, {episodes_skipped} ya existían."
@@ -341,135 +923,338 @@ class SpotifyPodcastExtractor:
             logger.error(f"Error al procesar la playlist: {e}", exc_info=True)
             return []
 
-    def categorize_pending_episodes(self):
+    @staticmethod
+    def _spotify_session() -> requests.Session:
+        # spotipy no permite desactivar respect_retry_after_header en su sesión, y
+        # urllib3 reintenta así cualquier 429 con Retry-After (durmiendo el valor
+        # entero). Sesión propia: urllib3 solo reintenta conexión y 5xx sin mirar
+        # Retry-After, y los 429 llegan a _spotify_call
+        retry = Retry(
+            total=SPOTIFY_HTTP_RETRIES,
+            connect=None,
+            read=False,
+            allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+            status=SPOTIFY_HTTP_RETRIES,
+            backoff_factor=0.3,
+            status_forcelist=SPOTIFY_RETRY_STATUS_CODES,
+            respect_retry_after_header=False,
+        )
+        adapter = HTTPAdapter(max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def _throttle_spotify(self):
+        # Ventana deslizante de 1s compartida entre hilos: hasta
+        # SPOTIFY_REQUESTS_PER_SECOND peticiones por segundo, permitiendo ráfagas.
+        # Tras un 429 todos los hilos esperan hasta _spotify_blocked_until
+        with self._spotify_lock:
+            blocked_for = self._spotify_blocked_until - time.time()
+            while blocked_for > 0:
+                time.sleep(blocked_for)
+                blocked_for = self._spotify_blocked_until - time.time()
+            now = time.time()
+            while self._spotify_timestamps and now - self._spotify_timestamps[0] >= 1:
+                self._spotify_timestamps.popleft()
+            if len(self._spotify_timestamps) >= SPOTIFY_REQUESTS_PER_SECOND:
+                wait_time = 1 - (now - self._spotify_timestamps[0])
+                if wait_time > 0:
+                    time.sleep(wait_time)
+                self._spotify_timestamps.popleft()
+            self._spotify_timestamps.append(time.time())
+
+    def _spotify_call(self, fn, *args, **kwargs):
+        """Llama a la API de Spotify respetando el ritmo y reintentando ante un 429."""
+        for attempt in range(SPOTIFY_MAX_RETRIES):
+            self._throttle_spotify()
+            try:
+                return fn(*args, **kwargs)
+            except spotipy.SpotifyException as e:
+                if e.http_status != 429 or attempt == SPOTIFY_MAX_RETRIES - 1:
+                    raise
+                retry_after = (e.headers or {}).get("Retry-After")
+                try:
+                    wait_time = int(retry_after)
+                except (TypeError, ValueError):
+                    wait_time = 2**attempt
+                wait_time = min(wait_time, SPOTIFY_MAX_BACKOFF)
+                logger.warning(
+                    f"⚠️ Límite de Spotify alcanzado (429). Reintentando en {wait_time}s..."
+                )
+                # Sin el lock: quien lo tiene puede estar durmiendo en _throttle_spotify,
+                # que vuelve a leer el valor al despertar
+                self._spotify_blocked_until = max(
+                    self._spotify_blocked_until, time.time() + wait_time
+                )
+
+    def _fetch_episode_details(self, episode_ids: List[str]) -> Dict[str, Dict]:
+        """Obtiene los detalles con el endpoint por lotes de Spotify (hasta 50 IDs)."""
+        unique_ids = list(dict.fromkeys(episode_ids))
+        id_batches = [
+            unique_ids[i : i + SPOTIFY_EPISODES_BATCH_SIZE]
+            for i in range(0, len(unique_ids), SPOTIFY_EPISODES_BATCH_SIZE)
+        ]
+        details = {}
+        # Lotes en paralelo (I/O de red), con límite de ritmo
+        with ThreadPoolExecutor(max_workers=SPOTIFY_MAX_WORKERS) as executor:
+            for response in executor.map(
+                lambda batch: self._spotify_call(self.sp.episodes, batch), id_batches
+            ):
+                for episode in response.get("episodes", []):
+                    if episode:
+                        details[episode["id"]] = episode
+        if unique_ids:
+            logger.info(
+                f"Detalles de {len(details)} episodios obtenidos en {len(id_batches)} peticiones a Spotify."
+            )
+        missing = len(unique_ids) - len(details)
+        if missing:
+            logger.warning(
+                f"⚠️ Spotify no devolvió detalles de {missing} episodios; se guardarán sin descripción."
+            )
+        return details
+
+    @staticmethod
+    def _has_episode_details(episode: Dict) -> bool:
+        return bool(
+            (episode.get("description") or episode.get("html_description"))
+            and (episode.get("show") or {}).get("name")
+        )
+
+    @staticmethod
+    def _build_episode_data(item: Dict, full_episode_details: Dict) -> Dict:
+        episode_summary = item["track"]
+        descripcion = (
+            full_episode_details.get("description", "")
+            or full_episode_details.get("html_description", "")
+            or "Sin descripción"
+        )
+        return {
+            "id": episode_summary["id"],
+            "titulo": episode_summary.get("name", "Sin título"),
+            "descripcion": descripcion,
+            "duracion_minutos": round(episode_summary.get("duration_ms", 0) / 60000, 2),
+            "fecha_agregado_playlist": item.get("added_at", "Sin fecha"),
+            "url_spotify": episode_summary.get("external_urls", {}).get(
+                "spotify", "Sin URL"
+            ),
+            "podcast_show_name": full_episode_details.get("show", {}).get(
+                "name", "Desconocido"
+            ),
+            "categoria": "Sin categorizar",
+        }
+
+    def categorize_pending_episodes(self) -> int:
+        """Categoriza los episodios pendientes y devuelve cuántos se actualizaron."""
         if self.quota_exhausted or not self.use_gemini:
-            return
+            return 0
         uncategorized = self.get_uncategorized_episodes()
         if not uncategorized:
             logger.info("No hay episodios pendientes de categorizar.")
-            return
+            return 0
         logger.info(
             f"Encontrados {len(uncategorized)} episodios pendientes de categorizar."
         )
+        # Agrupa episodios con el mismo podcast, título y descripción (el mismo
+        # episodio en varias playlists): se categoriza uno por grupo
+        groups: Dict[Tuple[str, str, str], List[Dict]] = {}
+        for ep in uncategorized:
+            descripcion = ep["descripcion"] or "Sin descripción"
+            if descripcion == "Sin descripción":
+                continue
+            key = (ep["podcast_show_name"], ep["titulo"], descripcion)
+            groups.setdefault(key, []).append(ep)
+        representatives = [group[0] for group in groups.values()]
+        logger.info(
+            f"{len(representatives)} episodios únicos a categorizar "
+            f"({len(uncategorized) - sum(map(len, groups.values()))} sin descripción omitidos)."
+        )
+        if not representatives:
+            return 0
         existing_categories = self._get_existing_categories()
         logger.info(f"Se usarán {len(existing_categories)} categorías como contexto.")
         categorization_map = self._categorize_episodes_batch(
-            uncategorized, existing_categories
+            representatives, existing_categories
         )
-        updated_count = 0
-        for ep in uncategorized:
-            if ep["id"] in categorization_map:
-                self.update_episode_category(
-                    ep["id"], ep["playlist_id"], categorization_map[ep["id"]]
-                )
-                updated_count += 1
-        logger.info(f"Se actualizaron las categorías de {updated_count} episodios.")
+        rows = [
+            (categorization_map[group[0]["id"]], ep["id"], ep["playlist_id"])
+            for group in groups.values()
+            if group[0]["id"] in categorization_map
+            for ep in group
+        ]
+        self.update_episode_categories(rows)
+        logger.info(f"Se actualizaron las categorías de {len(rows)} episodios.")
+        return len(rows)
 
     def episode_exists_in_db(self, episode_id: str, playlist_id: str) -> bool:
-        with sqlite3.connect(self.db_path) as conn:
+        with self._get_conn() as conn:
             return (
                 conn.cursor()
-                .execute(
-                    "SELECT 1 FROM podcasts WHERE id = ? AND playlist_id = ?",
-                    (episode_id, playlist_id),
-                )
+                .execute(_SQL_EPISODE_EXISTS, (episode_id, playlist_id))
                 .fetchone()
                 is not None
             )
 
+    def _get_playlist_episode_ids(self, playlist_id: str) -> Set[str]:
+        with self._get_conn() as conn:
+            return {
+                row[0]
+                for row in conn.execute(
+                    "SELECT id FROM podcasts WHERE playlist_id = ?", (playlist_id,)
+                )
+            }
+
+    @staticmethod
+    def _episode_to_row(ep_data: Dict, playlist_id: str) -> Tuple:
+        return (
+            ep_data["id"],
+            ep_data["titulo"],
+            ep_data["descripcion"],
+            ep_data["duracion_minutos"],
+            ep_data["fecha_agregado_playlist"],
+            ep_data["url_spotify"],
+            ep_data["categoria"],
+            ep_data["podcast_show_name"],
+            playlist_id,
+        )
+
     def save_episode_to_db(self, ep_data: Dict, playlist_id: str):
-        with sqlite3.connect(self.db_path) as conn:
-            conn.cursor().execute(
-                """
-                INSERT OR REPLACE INTO podcasts (id, titulo, descripcion, duracion_minutos, 
-                fecha_agregado_playlist, url_spotify, categoria, podcast_show_name, playlist_id)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-                (
-                    ep_data["id"],
-                    ep_data["titulo"],
-                    ep_data["descripcion"],
-                    ep_data["duracion_minutos"],
-                    ep_data["fecha_agregado_playlist"],
-                    ep_data["url_spotify"],
-                    ep_data["categoria"],
-                    ep_data["podcast_show_name"],
-                    playlist_id,
-                ),
+        with self._get_conn() as conn:
+            conn.execute(
+                _SQL_INSERT_EPISODE, self._episode_to_row(ep_data, playlist_id)
             )
+        self._register_categories((ep_data["categoria"],))
+
+    def save_episodes_to_db(self, episodes: List[Dict], playlist_id: str):
+        """Guarda los episodios con un único executemany en una sola transacción."""
+        if not episodes:
+            return
+        # Ordenadas por (playlist_id, id), que con una sola playlist sigue la clave
+        # primaria (id, playlist_id): escrituras secuenciales en el B-tree
+        rows = sorted(
+            (self._episode_to_row(ep, playlist_id) for ep in episodes),
+            key=lambda row: (row[8], row[0]),
+        )
+        # En cargas grandes el índice de categoría se reconstruye una vez al final;
+        # DROP/CREATE van en la misma transacción, así un rollback conserva el índice
+        with self._get_conn() as conn:
+            conn.execute("BEGIN")
+            drop_index = len(rows) >= BULK_LOAD_INDEX_THRESHOLD
+            if drop_index:
+                (table_rows,) = conn.execute("SELECT COUNT(*) FROM podcasts").fetchone()
+                drop_index = len(rows) >= table_rows
+            if drop_index:
+                conn.execute("DROP INDEX IF EXISTS idx_podcasts_cat")
+            conn.executemany(_SQL_INSERT_EPISODE, rows)
+            if drop_index:
+                conn.execute(_SQL_CREATE_CATEGORY_INDEX)
             conn.commit()
+        self._register_categories(row[6] for row in rows)
 
     def update_sync_date(self, playlist_id: str, playlist_name: str):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._get_conn() as conn:
             conn.cursor().execute(
                 "INSERT OR REPLACE INTO playlists (id, nombre, ultima_sincronizacion) VALUES (?, ?, CURRENT_TIMESTAMP)",
                 (playlist_id, playlist_name),
             )
-            conn.commit()
 
     def get_uncategorized_episodes(self) -> List[Dict]:
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT id, titulo, descripcion, podcast_show_name, playlist_id FROM podcasts WHERE categoria = 'Sin categorizar'"
-            )
+        with self._get_conn() as conn:
             return [
-                dict(zip([c[0] for c in cursor.description], row))
-                for row in cursor.fetchall()
+                dict(row)
+                for row in conn.execute(
+                    "SELECT id, titulo, substr(descripcion, 1, ?) AS descripcion, "
+                    "podcast_show_name, playlist_id "
+                    "FROM podcasts WHERE categoria = 'Sin categorizar'",
+                    (PROMPT_DESCRIPTION_CHARS,),
+                )
             ]
 
     def update_episode_category(self, ep_id: str, pl_id: str, cat: str):
-        with sqlite3.connect(self.db_path) as conn:
-            conn.cursor().execute(
-                "UPDATE podcasts SET categoria = ? WHERE id = ? AND playlist_id = ?",
-                (cat, ep_id, pl_id),
-            )
+        with self._get_conn() as conn:
+            conn.cursor().execute(_SQL_UPDATE_CATEGORY, (cat, ep_id, pl_id))
+        self._register_categories((cat,))
+
+    def update_episode_categories(self, rows: List[Tuple[str, str, str]]):
+        """Aplica filas (categoria, id, playlist_id) en una sola transacción."""
+        if not rows:
+            return
+        with self._get_conn() as conn:
+            conn.execute("BEGIN")
+            conn.executemany(_SQL_UPDATE_CATEGORY, rows)
             conn.commit()
+        self._register_categories(row[0] for row in rows)
 
     def export_to_excel(
         self, filename: Optional[str] = None, playlist_id: Optional[str] = None
     ) -> Optional[str]:
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._get_conn() as conn:
                 query = (
                     "SELECT * FROM podcasts"
                     + (" WHERE playlist_id = ?" if playlist_id else "")
                     + " ORDER BY fecha_agregado_playlist DESC"
                 )
-                df = pd.read_sql_query(
-                    query, conn, params=[playlist_id] if playlist_id else []
+                # Lectura y escritura por bloques: en memoria solo hay uno a la vez
+                chunks = pd.read_sql_query(
+                    query,
+                    conn,
+                    params=[playlist_id] if playlist_id else [],
+                    chunksize=EXPORT_CHUNK_SIZE,
                 )
-            if df.empty:
-                logger.warning("No hay datos para exportar.")
-                return None
-            if not filename:
-                filename = f"spotify_podcasts_{playlist_id or 'all'}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-            for col in ["fecha_agregado_playlist", "fecha_procesado"]:
-                if col in df.columns:
-                    df[col] = pd.to_datetime(df[col], errors="coerce").dt.tz_localize(
-                        None
-                    )
-            df.rename(
-                columns={
-                    "titulo": "Título",
-                    "descripcion": "Descripción",
-                    "duracion_minutos": "Duración (min)",
-                    "fecha_agregado_playlist": "Fecha Agregado",
-                    "url_spotify": "URL Spotify",
-                    "categoria": "Categoría",
-                    "podcast_show_name": "Podcast",
-                    "playlist_id": "ID Playlist",
-                    "fecha_procesado": "Fecha Procesado",
-                },
-                inplace=True,
-            )
-            with pd.ExcelWriter(filename, engine="openpyxl") as writer:
-                df.to_excel(writer, sheet_name="Podcasts", index=False)
-                for column_cells in writer.sheets["Podcasts"].columns:
-                    length = max(len(str(cell.value)) for cell in column_cells)
-                    writer.sheets["Podcasts"].column_dimensions[
-                        column_cells[0].column_letter
-                    ].width = min(length + 2, 60)
+                first_chunk = next(chunks, None)
+                if first_chunk is None or first_chunk.empty:
+                    logger.warning("No hay datos para exportar.")
+                    return None
+                if not filename:
+                    filename = f"spotify_podcasts_{playlist_id or 'all'}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+                columns = [_EXPORT_COLUMN_NAMES.get(c, c) for c in first_chunk.columns]
+                widths = np.fromiter(map(len, columns), dtype=np.int64)
+                # constant_memory escribe fila a fila sin retener el libro en RAM; por
+                # eso las filas se escriben en orden en lugar de con df.to_excel, que
+                # escribe por columnas
+                with pd.ExcelWriter(
+                    filename,
+                    engine="xlsxwriter",
+                    engine_kwargs={
+                        "options": {
+                            "constant_memory": True,
+                            "default_date_format": "yyyy-mm-dd hh:mm:ss",
+                        }
+                    },
+                ) as writer:
+                    worksheet = writer.book.add_worksheet("Podcasts")
+                    header_format = writer.book.add_format({"bold": True, "border": 1})
+                    worksheet.write_row(0, 0, columns, header_format)
+                    worksheet.freeze_panes(1, 0)
+                    row_idx = 1
+                    for df in itertools.chain([first_chunk], chunks):
+                        date_columns = [
+                            col
+                            for col in ("fecha_agregado_playlist", "fecha_procesado")
+                            if col in df.columns
+                        ]
+                        df[date_columns] = df[date_columns].apply(
+                            lambda s: pd.to_datetime(s, errors="coerce").dt.tz_localize(
+                                None
+                            )
+                        )
+                        widths = np.maximum(
+                            widths,
+                            df.astype(str)
+                            .apply(lambda col: col.str.len())
+                            .max()
+                            .to_numpy(),
+                        )
+                        values = df.astype(object).where(df.notna(), None)
+                        for row in values.itertuples(index=False, name=None):
+                            worksheet.write_row(row_idx, 0, row)
+                            row_idx += 1
+                    # El ancho de columna puede fijarse al final, incluso en
+                    # constant_memory
+                    for i, width in enumerate((widths + 2).clip(max=60).tolist()):
+                        worksheet.set_column(i, i, width)
             logger.info(f"Archivo Excel generado: {filename}")
             return filename
         except Exception as e:
@@ -478,15 +1263,31 @@ class SpotifyPodcastExtractor:
 
     def get_database_stats(self) -> Dict:
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._get_conn() as conn:
                 cursor = conn.cursor()
-                cursor.execute("SELECT COUNT(*) FROM podcasts")
-                total = cursor.fetchone()[0]
+                # Un único recorrido de la tabla para todos los contadores
                 cursor.execute(
-                    "SELECT categoria, COUNT(*) FROM podcasts GROUP BY categoria ORDER BY 2 DESC"
+                    """
+                    SELECT COUNT(*) AS total,
+                           COUNT(DISTINCT CASE WHEN categoria != 'Sin categorizar' THEN categoria END) AS total_cats,
+                           COALESCE(SUM(CASE WHEN categoria = 'Sin categorizar' THEN 1 ELSE 0 END), 0) AS uncat,
+                           COUNT(DISTINCT playlist_id) AS total_pl
+                    FROM podcasts
+                    """
                 )
-                top_cat = cursor.fetchall()
-                return {"total_episodes": total, "top_categories": top_cat}
+                totals = cursor.fetchone()
+                # GROUP BY resuelto sobre idx_podcasts_cat
+                cursor.execute(
+                    "SELECT categoria, COUNT(*) FROM podcasts GROUP BY categoria ORDER BY 2 DESC LIMIT 10"
+                )
+                top_cat = [tuple(row) for row in cursor.fetchall()]
+                return {
+                    "total_episodes": totals["total"],
+                    "total_categories": totals["total_cats"],
+                    "uncategorized_episodes": totals["uncat"],
+                    "total_playlists": totals["total_pl"],
+                    "top_categories": top_cat,
+                }
         except Exception as e:
             logger.error(f"Error obteniendo stats: {e}")
             return {}
@@ -499,11 +1300,13 @@ class SpotifyPodcastExtractor:
             return None
 
         logger.info("Recuperando episodios de la base de datos para responder...")
-        with sqlite3.connect(self.db_path) as conn:
+        with self._get_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT id, titulo, descripcion FROM podcasts")
+            cursor.execute(
+                "SELECT id, titulo, substr(descripcion, 1, 500) FROM podcasts"
+            )
             episodes_for_prompt = [
-                {"id": row[0], "titulo": row[1], "descripcion": (row[2] or "")[:500]}
+                {"id": row[0], "titulo": row[1], "descripcion": row[2] or ""}
                 for row in cursor.fetchall()
             ]
 
@@ -526,7 +1329,7 @@ class SpotifyPodcastExtractor:
         4.  Si encuentras episodios relevantes, lista sus títulos y un resumen muy breve de por qué son relevantes para la pregunta.
 
         LISTA DE EPISODIOS (JSON):
-        {json.dumps(episodes_for_prompt, ensure_ascii=False, indent=2)}
+        {json.dumps(episodes_for_prompt, ensure_ascii=False, separators=(",", ":"))}
 
         Ahora, por favor, responde a la pregunta del usuario siguiendo las reglas.
         """
@@ -560,6 +1363,12 @@ def _export_and_log_stats(
     if filename:
         logger.info(f"🎉 ¡Proceso completado! Archivo generado: {filename}")
         stats = extractor.get_database_stats()
+        if stats:
+            logger.info(
+                f"📚 {stats['total_episodes']} episodios en {stats['total_playlists']} playlists, "
+                f"{stats['total_categories']} categorías, "
+                f"{stats['uncategorized_episodes']} sin categorizar."
+            )
         if stats and stats.get("top_categories"):
             logger.info("🏆 Top 5 categorías:")
             for cat, count in stats["top_categories"][:5]:
@@ -606,6 +1415,12 @@ def main():
     parser.add_argument(
         "--no-llm", action="store_true", help="Desactiva la categorización con Gemini."
     )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Muestra mensajes de depuración, incluidos los prompts enviados a Gemini.",
+    )
     parser.add_argument(
         "--reset-db",
         action="store_true",
@@ -620,6 +1435,8 @@ def main():
         help="(Opcional con --export-only) Exporta solo esta playlist.",
     )
     args = parser.parse_args()
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
 
     db_path = "spotify_podcasts.db"
     if args.reset_db:
@@ -627,6 +1444,10 @@ def main():
             if os.path.exists(db_path):
                 os.remove(db_path)
                 logger.info("✅ Base de datos reseteada.")
+            # En modo WAL un -wal/-shm sobrante se aplicaría a la base de datos nueva
+            for wal_path in (f"{db_path}-wal", f"{db_path}-shm"):
+                if os.path.exists(wal_path):
+                    os.remove(wal_path)
         else:
             logger.info("Operación cancelada.")
         return logger.info("Fin del reset")
@@ -638,9 +1459,11 @@ def main():
     gemini_api_key = os.getenv("GEMINI_API_KEY") if not args.no_llm else None
     model_name = os.getenv("GEMINI_MODEL_NAME", "gemini-1.5-flash")
     max_categories = int(os.getenv("MAX_CATEGORIES", "10"))
+    rpm_limit = int(os.getenv("GEMINI_RPM_LIMIT", "15"))
     playlist_id_from_env = os.getenv("SPOTIFY_PLAYLIST_ID")
     playlist_id = args.playlist_id or playlist_id_from_env
 
+    extractor = None
     try:
         if args.export_only:
             extractor = SpotifyPodcastExtractor(
@@ -666,6 +1489,7 @@ def main():
                 redirect_uri=None,
                 gemini_api_key=gemini_api_key,
                 model_name=model_name,
+                rpm_limit=rpm_limit,
                 db_path=db_path,  # CORRECCIÓN
             )
             logger.info(f"Preguntando al modelo: '{args.user_question}'")
@@ -691,6 +1515,7 @@ def main():
                 redirect_uri=redirect_uri,
                 gemini_api_key=gemini_api_key,
                 model_name=model_name,
+                rpm_limit=rpm_limit,
                 max_categories=max_categories,
                 db_path=db_path,
             )
@@ -709,6 +1534,9 @@ def main():
 
     except Exception as e:
         logger.error(f"❌ Error fatal en la ejecución: {e}", exc_info=True)
+    finally:
+        if extractor:
+            extractor.close()
 
 
 if __name__ == "__main__":